@@ -1,4 +1,20 @@
-from setuptools import setup
+from setuptools import setup, Extension
+
+# The Cython fill kernel is only built when Cython is available (pyproject.toml asks pip for it), otherwise swalign falls back to numba or plain Python
+# It is optional as well, so a missing C compiler only costs the compiled kernel and not the whole install
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize([
+        Extension('swalign._swfill', ['swalign/_swfill.pyx'], extra_compile_args=['-O3']),
+    ])
+    # cythonize hands back new Extension objects, so optional is set on those
+    for ext in ext_modules:
+        ext.optional = True
+except ImportError:
+    ext_modules = []
+
+# The AVX2 batch kernel is plain C loaded through ctypes, a failed build only leaves runBatch on numba
+ext_modules.append(Extension('swalign._swbatch', ['swalign/sw_kernel.c'], extra_compile_args=['-O3', '-std=c99'], optional=True))
 
 setup(
     name='swalign',
@@ -9,8 +25,12 @@ setup(
     author_email='bradley.yam@yale.edu',
     license='GPL',
     packages=['swalign'],
+    ext_modules=ext_modules,
     install_requires=[
-        'pandas',
+        'numpy',
     ],
+    extras_require={
+        'numba': ['numba'],
+    },
     zip_safe=False
 )
\ No newline at end of file
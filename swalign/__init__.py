@@ -11,7 +11,384 @@ __version__ = "1.0.0"
 ### Note: Smith-Waterman Algorithm
 
 import argparse
-import pandas as pd
+import ctypes
+import importlib.machinery
+import importlib.util
+import os
+import numpy as np
+
+try:
+    from numba import njit, prange
+    _hasNumba = True
+except ImportError:
+    _hasNumba = False
+    # Without numba the kernels below simply run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+    prange = range
+
+# Returns the path of a compiled file of the swalign package, find_spec on the package itself only locates it and does not run swalign/__init__.py
+def _findLibrary(name):
+    spec = importlib.util.find_spec('swalign')
+    if spec is None or spec.origin is None:
+        raise OSError("swalign is not installed")
+    for suffix in importlib.machinery.EXTENSION_SUFFIXES:
+        path = os.path.join(os.path.dirname(spec.origin), name + suffix)
+        if os.path.exists(path):
+            return path
+    raise OSError("%s was not built" % name)
+
+# The Cython build of the fill kernel, only present when the swalign package was installed with Cython available
+# It is loaded from its file like the batch kernel below, so running this script does not import a second copy of everything through swalign/__init__.py
+try:
+    _spec = importlib.util.spec_from_file_location('swalign._swfill', _findLibrary('_swfill'))
+    _swfill = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_swfill)
+    _cfill = _swfill.fill
+except (ImportError, OSError):
+    _cfill = None
+
+# The native AVX2 batch kernel (swalign/sw_kernel.c), it is a plain shared library so it is loaded with ctypes instead of imported
+try:
+    _cbatch = ctypes.CDLL(_findLibrary('_swbatch')).sw_batch
+    _cbatch.restype = ctypes.c_int
+    _cbatch.argtypes = [np.ctypeslib.ndpointer(np.int16, flags='C'), ctypes.c_int, np.ctypeslib.ndpointer(np.intp, flags='C'), ctypes.c_int,
+                        np.ctypeslib.ndpointer(np.int8, flags='C'), ctypes.c_int, ctypes.c_int, np.ctypeslib.ndpointer(np.intp, flags='C'),
+                        ctypes.c_int, ctypes.c_int, np.ctypeslib.ndpointer(np.int32, flags='C')]
+except (ImportError, AttributeError, OSError):
+    _cbatch = None
+
+# CuPy is only used for large problems and only if a CUDA device is actually present
+try:
+    import cupy
+    _hasCupy = cupy.cuda.is_available()
+except ImportError:
+    _hasCupy = False
+
+# Fill Kernel
+
+# _fill is the dynamic programming loop behind SWMatrix.fillMatrix. It works on the precomputed query profile and plain NumPy arrays only, so numba can compile it to native code.
+# When the profile P is empty the score matrix only holds a match and a mismatch value, the cells are then scored by comparing the symbol codes s1 and s2 and the profile is never built.
+# The matrix is cut into _BLOCK x _BLOCK blocks which are swept one block antidiagonal at a time (the wavefront), _fillBlock fills one block row by row so F and T are written in short contiguous runs.
+# The blocks of one block antidiagonal are independent of each other and are split across threads, they share nothing but the edge buffers, each block writing slots no other block of the same antidiagonal reads.
+# Only F and the traceback matrices are written out, M, Ix and Iy are only kept along the edges of the blocks, which keeps the working set of a block in L1 even for very long sequences.
+## _fillNumpy is the fallback when neither numba nor the Cython kernel is available. It sweeps the cell antidiagonals instead of blocks and handles a whole antidiagonal per NumPy call, so Python only loops over the n + m antidiagonals instead of every cell.
+## _cell computes M, Ix and Iy and the packed traceback byte of one cell from its nine neighbours (D upper left, U above, L to the left), which are read once into locals by the caller.
+## _pick returns the max of a, b, c and 0 together with a number from 0-3 telling us which one it was, ties go to the earliest value. It avoids building lists so no objects are allocated per cell.
+
+_BLOCK = 64
+
+@njit(cache=True)
+def _pick(a, b, c):
+    # single pass of compare and select, later values must be strictly bigger to win so ties keep the earliest index
+    ret, tag = a, 0
+    if b > ret:
+        ret, tag = b, 1
+    if c > ret:
+        ret, tag = c, 2
+    if 0 > ret:
+        ret, tag = 0, 3
+    return ret, tag
+
+@njit(cache=True)
+def _cell(sc, o, e, mD, ixD, iyD, mU, ixU, iyU, mL, ixL, iyL):
+    #compute the score for the match matrix from the upper left cell
+    ret1, tag = _pick(mD + sc, ixD + sc, iyD + sc) #match xi with yj, insertion in x, insertion in y
+    #a number from 0-3 will tell us where the sequence came from, 3 also when the traceback would step onto a 0 in M
+    tm = 3 if mD == 0 else tag
+
+    #compute the score for the Ix matrix from the cell above
+    ret2, tag = _pick(mU + o, ixU + e, iyU + o) #open gap in x, extend gap in x, open gap after existing gap in y
+    tix = 3 if ixU == 0 else tag
+
+    #compute the score for the Iy matrix from the cell to the left
+    ret3, tag = _pick(mL + o, ixL + o, iyL + e) #open gap in y, open gap after existing gap in x, extend gap in y
+    tiy = 3 if iyL == 0 else tag
+
+    #pack the three numbers into one byte, bit 6 is set when M is 0 here
+    return ret1, ret2, ret3, tm | (tix << 2) | (tiy << 4) | (64 if ret1 == 0 else 0)
+
+@njit(cache=True, boundscheck=False)
+def _fillBlock(P, s1, s2, match, mismatch, o, e, F, T, rowMax, rowArg, rowM, rowIx, rowIy, colM, colIx, colIy, bi, bj, B):
+    n, m = F.shape
+    plain = P.shape[0] == 0
+    i0, i1 = bi * B + 1, min(n, (bi + 1) * B + 1)
+    j0, j1 = bj * B + 1, min(m, (bj + 1) * B + 1)
+    # one row of M, Ix and Iy for the block and the column to its left, it starts as the last row of the block above
+    uM = rowM[bi, j0-1:j1].copy()
+    uIx = rowIx[bi, j0-1:j1].copy()
+    uIy = rowIy[bi, j0-1:j1].copy()
+    for i in range(i0, i1):
+        # the upper left value of the first cell is the left column of the row above, the row is then overwritten in place
+        mD, ixD, iyD = uM[0], uIx[0], uIy[0]
+        uM[0], uIx[0], uIy[0] = colM[bj, i], colIx[bj, i], colIy[bj, i]
+        si = s2[i]
+        for j in range(j0, j1):
+            c = j - j0 + 1
+            mU, ixU, iyU = uM[c], uIx[c], uIy[c]
+            sc = (match if s1[j] == si else mismatch) if plain else P[i,j]
+            ret1, ret2, ret3, T[i,j] = _cell(sc, o, e, mD, ixD, iyD, mU, ixU, iyU, uM[c-1], uIx[c-1], uIy[c-1])
+            mD, ixD, iyD = mU, ixU, iyU
+            uM[c], uIx[c], uIy[c] = ret1, ret2, ret3
+
+            #get best score and remember the first place it is reached in this row, the blocks of a row are always filled left to right and never at the same time
+            best = max(ret1, ret2, ret3)
+            F[i,j] = best
+            if best > rowMax[i]:
+                rowMax[i] = best
+                rowArg[i] = j
+        # the last column goes to the block on the right
+        colM[bj+1, i], colIx[bj+1, i], colIy[bj+1, i] = uM[-1], uIx[-1], uIy[-1]
+    # and the last row to the block below
+    rowM[bi+1, j0:j1] = uM[1:]
+    rowIx[bi+1, j0:j1] = uIx[1:]
+    rowIy[bi+1, j0:j1] = uIy[1:]
+
+@njit(cache=True, boundscheck=False, parallel=True)
+def _fill(P, o, e, F, T, rowMax, rowArg, s1, s2, match, mismatch):
+    n, m = F.shape
+    B = _BLOCK
+    nbi, nbj = (n + B - 2) // B, (m + B - 2) // B
+    # row[bi] holds M, Ix and Iy along the row just above block row bi and col[bj] along the column just left of block column bj, both start at the zero border
+    rowM, rowIx, rowIy = np.zeros((nbi + 1, m), F.dtype), np.zeros((nbi + 1, m), F.dtype), np.zeros((nbi + 1, m), F.dtype)
+    colM, colIx, colIy = np.zeros((nbj + 1, n), F.dtype), np.zeros((nbj + 1, n), F.dtype), np.zeros((nbj + 1, n), F.dtype)
+    # walk the block antidiagonals bi + bj = k, a block only needs the blocks above and to the left of it so the blocks of one are split across threads
+    for k in range(nbi + nbj - 1):
+        for bi in prange(max(0, k - nbj + 1), min(nbi - 1, k) + 1):
+            _fillBlock(P, s1, s2, match, mismatch, o, e, F, T, rowMax, rowArg, rowM, rowIx, rowIy, colM, colIx, colIy, bi, k - bi, B)
+
+def _pickNumpy(a, b, c):
+    # argmax returns the first index on ties, the same rule _pick follows
+    stacked = np.stack((a, b, c, np.zeros_like(a)))
+    tag = stacked.argmax(axis=0)
+    return np.take_along_axis(stacked, tag[None, :], axis=0)[0], tag
+
+def _fillNumpy(P, o, e, F, T, rowMax, rowArg):
+    n, m = F.shape
+    M2, M1, M0 = np.zeros((3, n), F.dtype)
+    Ix2, Ix1, Ix0 = np.zeros((3, n), F.dtype)
+    Iy2, Iy1, Iy0 = np.zeros((3, n), F.dtype)
+    for k in range(2, n + m - 1):
+        if k < n:
+            M0[k] = Ix0[k] = Iy0[k] = 0
+        # gather the whole antidiagonal and update it with one vectorized operation per matrix
+        i = np.arange(max(1, k - m + 1), min(n - 1, k - 1) + 1)
+        j = k - i
+        sc = P[i,j]
+        ret1, tag = _pickNumpy(M2[i-1] + sc, Ix2[i-1] + sc, Iy2[i-1] + sc)
+        tm = np.where(M2[i-1] == 0, 3, tag)
+        ret2, tag = _pickNumpy(M1[i-1] + o, Ix1[i-1] + e, Iy1[i-1] + o)
+        tix = np.where(Ix1[i-1] == 0, 3, tag)
+        ret3, tag = _pickNumpy(M1[i] + o, Ix1[i] + o, Iy1[i] + e)
+        tiy = np.where(Iy1[i] == 0, 3, tag)
+        T[i,j] = tm | (tix << 2) | (tiy << 4) | np.where(ret1 == 0, 64, 0)
+        M0[i], Ix0[i], Iy0[i] = ret1, ret2, ret3
+        best = np.maximum(np.maximum(ret1, ret2), ret3)
+        F[i,j] = best
+        better = best > rowMax[i]
+        rowMax[i[better]] = best[better]
+        rowArg[i[better]] = j[better]
+        M2, M1, M0 = M1, M0, M2
+        Ix2, Ix1, Ix0 = Ix1, Ix0, Ix2
+        Iy2, Iy1, Iy0 = Iy1, Iy0, Iy2
+
+# Batch Kernel
+
+# _batchFill aligns one query against many references at once and only keeps the best score of each. The references are interleaved into lanes, refs[i, n] is symbol i of reference n,
+# so the innermost loop advances every reference by one cell with the same instructions, which numba can turn into SIMD code (inter-sequence vectorization as in SWIPE).
+## Before each row a lane profile is built, prof[c, n] is the score of symbol c against the current symbol of reference n, so the inner loop only does contiguous loads.
+## lens[n] is the length of reference n, rows past it are padding and are kept out of the max.
+## M, Ix and Iy hold the previous row of every lane and are overwritten in place, the diag arrays keep the value the upper left cell had before it was overwritten.
+## The lanes use the dtype of score, best is always int32.
+
+@njit(cache=True, boundscheck=False)
+def _batchFill(score, q, refs, lens, o, e, best):
+    lq = len(q)
+    lr, lanes = refs.shape
+    prof = np.zeros((score.shape[0], lanes), score.dtype)
+    live = np.zeros(lanes, score.dtype)
+    M = np.zeros((lq, lanes), score.dtype)
+    Ix = np.zeros((lq, lanes), score.dtype)
+    Iy = np.zeros((lq, lanes), score.dtype)
+    mDiag = np.zeros(lanes, score.dtype)
+    ixDiag = np.zeros(lanes, score.dtype)
+    iyDiag = np.zeros(lanes, score.dtype)
+    for i in range(1, lr):
+        for c in range(score.shape[0]):
+            for n in range(lanes):
+                prof[c, n] = score[c, refs[i, n]]
+        for n in range(lanes):
+            live[n] = 1 if i <= lens[n] else 0
+        mDiag[:] = 0
+        ixDiag[:] = 0
+        iyDiag[:] = 0
+        for j in range(1, lq):
+            row = prof[q[j]]
+            for n in range(lanes):
+                sc = row[n]
+                mpc, ixpc, iypc = M[j, n], Ix[j, n], Iy[j, n]
+                ret1 = max(mDiag[n] + sc, ixDiag[n] + sc, iyDiag[n] + sc, 0)
+                ret2 = max(mpc + o, ixpc + e, iypc + o, 0)
+                ret3 = max(M[j-1, n] + o, Ix[j-1, n] + o, Iy[j-1, n] + e, 0)
+                mDiag[n], ixDiag[n], iyDiag[n] = mpc, ixpc, iypc
+                M[j, n], Ix[j, n], Iy[j, n] = ret1, ret2, ret3
+                best[n] = max(best[n], live[n] * max(ret1, ret2, ret3))
+
+# Score Width
+### The fill kernels store M, Ix, Iy and F in the dtype of the arrays they are given, int16 halves the memory they move.
+### Every stored value is at least 0, so int16 is safe as long as no single step can push a score past 32767 or below -32768.
+### A fill can only tell it went too far after the fact, _scoreLimit is the highest score that can still be followed by one more step.
+### The best scores the kernels report are always int32, so a score past the limit is never lost to a later wrap around.
+
+def _scoreType(matrix, openGap, extGap):
+    step = max(abs(int(matrix.min())), abs(int(matrix.max())), abs(openGap), abs(extGap))
+    return np.int16 if step <= np.iinfo(np.int16).max // 2 else np.int32
+
+def _scoreLimit(matrix, openGap, extGap):
+    return np.iinfo(np.int16).max - max(int(matrix.max()), openGap, extGap, 0)
+
+# _batchFillNative runs the same fill through the C kernel, which only has int16 lanes and saturates instead of wrapping.
+
+def _batchFillNative(score, q, refs, lens, o, e, best):
+    if _cbatch(score, score.shape[0], q, len(q), refs, refs.shape[0], refs.shape[1], lens, o, e, best) != 0:
+        raise MemoryError("could not allocate the buffers of the batch kernel")
+
+# Plain Scores
+
+### Returns (match, mismatch) when the scores between the given symbol indices only take those two values, otherwise None.
+### Matrices like that (DNA scoring for instance) are scored by _fill straight from the symbol codes, without a query profile.
+def _plainScore(matrix, used):
+    sub = matrix[np.ix_(used, used)]
+    off = sub[~np.eye(len(used), dtype=bool)]
+    if len(used) == 0 or (sub.diagonal() != sub[0, 0]).any() or (off.size and (off != off[0]).any()):
+        return None
+    return int(sub[0, 0]), int(off[0]) if off.size else 0
+
+# GPU Kernels
+
+# With CuPy and a CUDA device, pairs where both sequences are longer than _GPU_MIN symbols and batches of at least _GPU_MIN_REFS references are filled on the GPU.
+# There is one launch per antidiagonal, so it is the shorter sequence, the length of the antidiagonals, that decides whether the launches are worth it.
+# sw_diag fills one antidiagonal of the matrix with one thread per cell, exactly like _fillNumpy, the launches on one stream run in order so each sees the previous two antidiagonals.
+# It scores the cells from the symbol codes and the small score matrix, so the device holds no query profile, only F, the packed traceback matrix and the rolling buffers.
+# F and the packed traceback matrix are copied back once at the end, the traceback itself stays on the CPU.
+## sw_batch aligns the query against one reference per thread and only keeps the best score, the references are interleaved as in _batchFill so neighbouring threads read neighbouring bytes.
+## Both work in int32, fillMatrix hands _fillGpu an int32 F from the start so the int16 retry never runs the GPU fill twice.
+
+_GPU_MIN = 4096
+_GPU_MIN_REFS = 4096
+
+_GPU_SOURCE = r"""
+__device__ int pick(int a, int b, int c, int *tag)
+{
+    int ret = a;
+    *tag = 0;
+    if (b > ret) { ret = b; *tag = 1; }
+    if (c > ret) { ret = c; *tag = 2; }
+    if (0 > ret) { ret = 0; *tag = 3; }
+    return ret;
+}
+
+extern "C" __global__ void sw_diag(const int *score, int nsym, const signed char *s1, const signed char *s2, int n, int m, int o, int e, int k,
+                                   const int *M2, const int *Ix2, const int *Iy2, const int *M1, const int *Ix1, const int *Iy1,
+                                   int *M0, int *Ix0, int *Iy0, int *F, unsigned char *T, int *rowMax, long long *rowArg)
+{
+    int i = max(1, k - m + 1) + blockIdx.x * blockDim.x + threadIdx.x;
+    if (i > min(n - 1, k - 1))
+        return;
+    int j = k - i;
+    int tag;
+    /* the buffers are indexed by row, cells on the first row or column are 0 */
+    int mD = (i > 1 && j > 1) ? M2[i-1] : 0, ixD = (i > 1 && j > 1) ? Ix2[i-1] : 0, iyD = (i > 1 && j > 1) ? Iy2[i-1] : 0;
+    int mU = i > 1 ? M1[i-1] : 0, ixU = i > 1 ? Ix1[i-1] : 0, iyU = i > 1 ? Iy1[i-1] : 0;
+    int mL = j > 1 ? M1[i] : 0, ixL = j > 1 ? Ix1[i] : 0, iyL = j > 1 ? Iy1[i] : 0;
+    int sc = score[s1[j] * nsym + s2[i]];
+
+    int ret1 = pick(mD + sc, ixD + sc, iyD + sc, &tag);
+    int tm = mD == 0 ? 3 : tag;
+    int ret2 = pick(mU + o, ixU + e, iyU + o, &tag);
+    int tix = ixU == 0 ? 3 : tag;
+    int ret3 = pick(mL + o, ixL + o, iyL + e, &tag);
+    int tiy = iyL == 0 ? 3 : tag;
+    T[(long long)i * m + j] = tm | (tix << 2) | (tiy << 4) | (ret1 == 0 ? 64 : 0);
+    M0[i] = ret1;
+    Ix0[i] = ret2;
+    Iy0[i] = ret3;
+
+    /* a row only has one cell per antidiagonal, so only one thread ever touches rowMax[i] at a time */
+    int best = max(ret1, max(ret2, ret3));
+    F[(long long)i * m + j] = best;
+    if (best > rowMax[i]) {
+        rowMax[i] = best;
+        rowArg[i] = j;
+    }
+}
+
+extern "C" __global__ void sw_batch(const int *score, int nsym, const long long *q, int lq, const signed char *refs, int lanes,
+                                    const long long *lens, int o, int e, int *M, int *Ix, int *Iy, int *best)
+{
+    int n = blockIdx.x * blockDim.x + threadIdx.x;
+    if (n >= lanes)
+        return;
+    int top = 0;
+    for (int i = 1; i <= lens[n]; i++) {
+        const int *row = score + refs[(long long)i * lanes + n];
+        int mD = 0, ixD = 0, iyD = 0, mL = 0, ixL = 0, iyL = 0;
+        for (int j = 1; j < lq; j++) {
+            long long at = (long long)j * lanes + n;
+            int sc = row[q[j] * nsym];
+            int mU = M[at], ixU = Ix[at], iyU = Iy[at];
+            int ret1 = max(max(mD, max(ixD, iyD)) + sc, 0);
+            int ret2 = max(max(mU + o, ixU + e), max(iyU + o, 0));
+            int ret3 = max(max(mL + o, ixL + o), max(iyL + e, 0));
+            mD = mU; ixD = ixU; iyD = iyU;
+            M[at] = mL = ret1;
+            Ix[at] = ixL = ret2;
+            Iy[at] = iyL = ret3;
+            top = max(top, max(ret1, max(ret2, ret3)));
+        }
+    }
+    best[n] = top;
+}
+"""
+
+if _hasCupy:
+    _gpuModule = cupy.RawModule(code=_GPU_SOURCE)
+
+def _fillGpu(score, s1, s2, o, e, F, T, rowMax, rowArg):
+    n, m = F.shape
+    kernel = _gpuModule.get_function('sw_diag')
+    dScore = cupy.asarray(score, dtype=cupy.int32)
+    dS1 = cupy.asarray(s1)
+    dS2 = cupy.asarray(s2)
+    dF = cupy.zeros((n, m), dtype=cupy.int32)
+    dT = cupy.asarray(T)
+    dMax = cupy.zeros(n, dtype=cupy.int32)
+    dArg = cupy.zeros(n, dtype=cupy.int64)
+    bufs = [cupy.zeros(n, dtype=cupy.int32) for _ in range(9)]
+    M2, M1, M0, Ix2, Ix1, Ix0, Iy2, Iy1, Iy0 = bufs
+    for k in range(2, n + m - 1):
+        cells = min(n - 1, k - 1) - max(1, k - m + 1) + 1
+        kernel(((cells + 255) // 256,), (256,), (dScore, np.int32(score.shape[0]), dS1, dS2, np.int32(n), np.int32(m), np.int32(o), np.int32(e), np.int32(k),
+                                                  M2, Ix2, Iy2, M1, Ix1, Iy1, M0, Ix0, Iy0, dF, dT, dMax, dArg))
+        M2, M1, M0 = M1, M0, M2
+        Ix2, Ix1, Ix0 = Ix1, Ix0, Ix2
+        Iy2, Iy1, Iy0 = Iy1, Iy0, Iy2
+    F[...] = dF.get()
+    T[...] = dT.get()
+    rowMax[...] = dMax.get()
+    rowArg[...] = dArg.get()
+
+def _batchFillGpu(score, q, refs, lens, o, e, best):
+    lanes = refs.shape[1]
+    kernel = _gpuModule.get_function('sw_batch')
+    buf = [cupy.zeros((len(q), lanes), dtype=cupy.int32) for _ in range(3)]
+    dBest = cupy.zeros(lanes, dtype=cupy.int32)
+    kernel(((lanes + 127) // 128,), (128,), (cupy.asarray(score, dtype=cupy.int32), np.int32(score.shape[0]), cupy.asarray(q, dtype=cupy.int64),
+                                             np.int32(len(q)), cupy.asarray(refs), np.int32(lanes), cupy.asarray(lens, dtype=cupy.int64),
+                                             np.int32(o), np.int32(e), *buf, dBest))
+    best[...] = dBest.get()
 
 # SW Class Matrix
 
@@ -24,157 +401,249 @@ class SWMatrix:
         self.seq1 = "\t" + seq1
         self.seq2 = "\t" + seq2
 
-        # Initialize the final score matrix
-        self.F = pd.DataFrame(0, index = [char for char in self.seq2], columns = [char for char in self.seq1])
+        # Encode both sequences as indices into the score matrix so the fill only touches plain integer arrays
+        alphabet, self.score_np = score
+        lut = buildLut(alphabet)
+        self.s1 = np.zeros(len(self.seq1), dtype=np.int8)
+        self.s1[1:] = encodeSeq(lut, seq1)
+        self.s2 = np.zeros(len(self.seq2), dtype=np.int8)
+        self.s2[1:] = encodeSeq(lut, seq2)
+        shape = (len(self.seq2), len(self.seq1))
 
-        # Initialize the Match Matrix such that M(0,0) = 0
-        self.M = pd.DataFrame(0, index = [char for char in self.seq2], columns = [char for char in self.seq1])
+        # Initialize the final score matrix
+        # Scores are kept in int16 when the score matrix and penalties are small, fillMatrix moves to int32 if an alignment gets too big for it
+        self.F = np.zeros(shape, dtype=_scoreType(self.score_np, self.o, self.e))
+        self._P = None
 
-        #Initialize the Gap X Matric such that Ix(i, 0) = open penalty + gap penalty * i (in this instance we floor everything to 0)
-        self.Ix = pd.DataFrame(0, index = [char for char in self.seq2], columns = [char for char in self.seq1])
+        #Initialize the packed traceback matrix which will hold numbers that refer to which path each matrix took from the previous one
+        self.T = np.zeros(shape, dtype=np.uint8)
+        # M is 0 along the first row and column
+        self.T[0, :] = 64
+        self.T[:, 0] = 64
 
-        #Initialize the Gap Y Matric such that Ix(i, 0) = open penalty + gap penalty * j (in this instance we floor everything to 0)
-        self.Iy = pd.DataFrame(0, index = [char for char in self.seq2], columns = [char for char in self.seq1])
-        
-        #Initialize traceback matrices which will hold a number that refers to which path it took from the previous matrix
-        self.TM = pd.DataFrame(0, index = [char for char in self.seq2], columns = [char for char in self.seq1])
-        self.TIx = pd.DataFrame(0, index = [char for char in self.seq2], columns = [char for char in self.seq1])
-        self.TIy = pd.DataFrame(0, index = [char for char in self.seq2], columns = [char for char in self.seq1])
+        # The best score and its coordinates, filled in by fillMatrix
+        self.maxScore = 0
+        self.maxI = 0
+        self.maxJ = 0
 
     def fillMatrix(self):
-        for i in range(1, len(self.seq2)):
-            for j in range(1, len(self.seq1)):
-                #compute the score for the match matrix
-                score = self.score.at[self.seq1[j], self.seq2[i]]
-                a = self.M.iat[i-1, j-1] + score #match xi with yj
-                b = self.Ix.iat[i-1, j-1] + score #insertion in x
-                c = self.Iy.iat[i-1, j-1] + score #insertion in y
-                ret1 = max([a, b, c, 0])
-                self.M.iat[i,j] = ret1 
-                #a number from 0-3 will tell us where the sequence came from
-                self.TM.iat[i,j] = [a,b,c,0].index(ret1) 
-
-                #compute the score for the Ix matrix
-                a = self.M.iat[i-1,j] + self.o #open gap in x
-                b = self.Ix.iat[i-1,j] + self.e #extend gap in x
-                c = self.Iy.iat[i-1,j] + self.o #open gap after existing gap in y
-                ret2 = max([a, b, c, 0]) #magic to make state match with matrix
-                self.Ix.iat[i,j] = ret2
-                #a number from 0-2 will tell us where the sequence came from
-                self.TIx.iat[i,j] = [a,b,c,0].index(ret2) 
-
-                #compute the score for the Iy matrix
-                a = self.M.iat[i,j-1] + self.o #open gap in y
-                b = self.Ix.iat[i,j-1] + self.o #open gap after existing gap in x
-                c = self.Iy.iat[i,j-1] + self.e#extend gap in y
-                ret3 = max([a, b, c, 0])
-                self.Iy.iat[i,j] = ret3
-                #a number from 0-2 will tell us where the sequence came from
-                self.TIy.iat[i,j] = [a,b,c,0].index(ret3) 
-
-                #get best score
-                self.F.iat[i,j] = max([ret1, ret2, ret3])
+        # long sequences go to the GPU when there is one, otherwise numba is preferred, then the compiled Cython kernel, then the vectorized NumPy sweep
+        if _hasCupy and min(len(self.seq1), len(self.seq2)) > _GPU_MIN:
+            kernel = _fillGpu
+            self.F = self.F.astype(np.int32)
+        elif _hasNumba:
+            kernel = _fill
+        elif _cfill is not None:
+            kernel = _cfill
+        else:
+            kernel = _fillNumpy
+        # with plain match/mismatch scoring _fill looks the scores up itself and the query profile is never built
+        plain = None
+        if kernel is _fill:
+            plain = _plainScore(self.score_np, np.unique(np.concatenate((self.s1[1:], self.s2[1:]))))
+        # the kernels track the best score of every row as they go, so finding the overall best only looks at n values
+        while True:
+            rowMax = np.zeros(len(self.seq2), dtype=np.int32)
+            rowArg = np.zeros(len(self.seq2), dtype=np.intp)
+            if kernel is _fill:
+                P = np.zeros((0, 0), dtype=self.F.dtype) if plain else self.P
+                _fill(P, self.o, self.e, self.F, self.T, rowMax, rowArg, self.s1, self.s2, *(plain or (0, 0)))
+            elif kernel is _fillGpu:
+                _fillGpu(self.score_np, self.s1, self.s2, self.o, self.e, self.F, self.T, rowMax, rowArg)
+            else:
+                kernel(self.P, self.o, self.e, self.F, self.T, rowMax, rowArg)
+            # rowMax is always int32 so it still holds the first score past the int16 limit even if the tables wrapped after it, the fill is then redone in int32
+            if self.F.dtype == np.int32 or rowMax.max() <= _scoreLimit(self.score_np, self.o, self.e):
+                break
+            self.F = np.zeros(self.F.shape, dtype=np.int32)
+        self.maxI = int(rowMax.argmax())
+        self.maxJ = int(rowArg[self.maxI])
+        self.maxScore = rowMax[self.maxI]
+
+    # The query profile, P[i,j] holds the score of seq1[j] against seq2[i] so the fill never goes back to the score matrix
+    # It is built the first time a kernel needs it and again if F has moved to int32 since
+    @property
+    def P(self):
+        if self._P is None or self._P.dtype != self.F.dtype:
+            # gather whole columns of the small score matrix first and then whole rows, much cheaper than one n x m fancy index
+            self._P = np.ascontiguousarray(self.score_np.T.astype(self.F.dtype)[:, self.s1][self.s2])
+        return self._P
 
     def getMax(self):
-        return self.F.max().max()
+        return self.maxScore
 
     def getMaxCoord(self):
-        i = self.F.max(axis=1).argmax()
-        j = self.F.iloc[i].argmax()
-        return i, j
-
-    def completeFront(self, i, j):
-        self.matchStr1.append('(')
-        self.matchStr2.append('(')
-        self.matchLine.append(' ')
+        return self.maxI, self.maxJ
+
+    def completeFront(self, i, j, p):
+        self.matchStr1[p] = self.matchStr2[p] = ord('(')
+        p += 1
         while i > 0 or j > 0:
             if j > 0:
-                self.matchStr1.append(self.seq1[j])
-            else:
-                self.matchStr1.append(' ')
-            self.matchLine.append(' ')
+                self.matchStr1[p] = self.bytes1[j]
             if i > 0:
-                self.matchStr2.append(self.seq2[i])
-            else:
-                self.matchStr2.append(' ')
+                self.matchStr2[p] = self.bytes2[i]
+            p += 1
             i -= 1
             j -= 1
+        return p
     
-    def completeBack(self, i, j):
-        self.matchStr1.append(')')
-        self.matchStr2.append(')')
-        self.matchLine.append(' ')
+    def completeBack(self, i, j, p):
+        self.matchStr1[p] = self.matchStr2[p] = ord(')')
+        p += 1
         while i < len(self.seq2) or j < len(self.seq1):
             if j < len(self.seq1):
-                self.matchStr1.append(self.seq1[j])
-            else:
-                self.matchStr1.append(' ')
-            self.matchLine.append(' ')
+                self.matchStr1[p] = self.bytes1[j]
             if i < len(self.seq2):
-                self.matchStr2.append(self.seq2[i])
-            else:
-                self.matchStr2.append(' ')
+                self.matchStr2[p] = self.bytes2[i]
+            p += 1
             i += 1
             j += 1
+        return p
 
     def traceback(self, x, y):
-        # 0 = M matrix, 1 = Ix matrix, 2 = Iy matrix
-        state = 0
-        self.matchStr1 = []
-        self.matchStr2 = []
-        self.matchLine = []
+        # 0 = M matrix, 1 = Ix matrix, 2 = Iy matrix, 3 = halt
+        # the alignment is written byte by byte into buffers prefilled with spaces, p is the write position
+        self.bytes1 = self.seq1.encode('ascii')
+        self.bytes2 = self.seq2.encode('ascii')
+        cap = 2 * (len(self.seq1) + len(self.seq2))
+        self.matchStr1 = bytearray(b' ' * cap)
+        self.matchStr2 = bytearray(b' ' * cap)
+        self.matchLine = bytearray(b' ' * cap)
+        p = 0
         i = x
         j = y
         i, j = self.getMaxCoord()
-        currVal = self.M.iat[i,j]
-        while currVal != 0 and state != 3:
-            if self.seq1[j] == self.seq2[i]:
-                self.matchLine.append('|')
-            else:
-                self.matchLine.append(' ')
-            # print(state, i, j, self.seq1[j], self.seq2[i])
+        # the scores are gone after the fill, the traceback matrices already encode where the path runs into a 0
+        state = 3 if self.T[i,j] & 64 else 0
+        while state != 3:
+            if self.bytes1[j] == self.bytes2[i]:
+                self.matchLine[p] = ord('|')
             if state == 0:
-                nstate = self.TM.iat[i,j]
-                self.matchStr1.append(self.seq1[j])
-                self.matchStr2.append(self.seq2[i])
+                state = self.T[i,j] & 3
+                self.matchStr1[p] = self.bytes1[j]
+                self.matchStr2[p] = self.bytes2[i]
                 i -= 1
                 j -= 1
-                state = nstate
-                currVal = self.M.iat[i,j]
             elif state == 1:
-                nstate = self.TIx.iat[i,j]
-                self.matchStr1.append('-')
-                self.matchStr2.append(self.seq2[i])
+                state = (self.T[i,j] >> 2) & 3
+                self.matchStr1[p] = ord('-')
+                self.matchStr2[p] = self.bytes2[i]
                 i -= 1
-                state = nstate
-                currVal = self.Ix.iat[i,j]
             elif state == 2:
-                nstate = self.TIy.iat[i,j]
-                self.matchStr1.append(self.seq1[j])
-                self.matchStr2.append('-')
+                state = (self.T[i,j] >> 4) & 3
+                self.matchStr1[p] = self.bytes1[j]
+                self.matchStr2[p] = ord('-')
                 j -= 1
-                state = nstate
-                currVal = self.Iy.iat[i,j]
-        self.completeFront(i, j)
-        self.matchStr1.reverse()
-        self.matchLine.reverse()
-        self.matchStr2.reverse()
-        i, j = self.getMaxCoord()
-        self.completeBack(i+1, j+1)
-
-### This is one way to read in arguments in Python.
-parser = argparse.ArgumentParser(description='Smith-Waterman Affine Gap Algorithm')
-parser.add_argument('-i', '--input', help='input file', required=True)
-parser.add_argument('-s', '--score', help='score file', required=True)
-parser.add_argument('-o', '--opengap', help='open gap', required=False,
-default=-2)
-parser.add_argument('-e', '--extgap', help='extension gap', required=False,
-default=-1)
-args = parser.parse_args()
+            p += 1
+        p = self.completeFront(i, j, p)
+        # everything so far was written from the best cell backwards
+        self.matchStr1[:p] = self.matchStr1[p-1::-1]
+        self.matchLine[:p] = self.matchLine[p-1::-1]
+        self.matchStr2[:p] = self.matchStr2[p-1::-1]
+        p = self.completeBack(self.maxI+1, self.maxJ+1, p)
+        self.matchStr1 = self.matchStr1[:p].decode('ascii')
+        self.matchLine = self.matchLine[:p].decode('ascii')
+        self.matchStr2 = self.matchStr2[:p].decode('ascii')
+
+### Read a score matrix file, the first line holds the symbols and every other line a symbol followed by its scores.
+### Returns a dict from symbol to index and the matrix of scores as a NumPy array.
+def loadScore(scoreFile):
+    with open(scoreFile) as f:
+        rows = [line.split() for line in f if line.strip()]
+    alphabet = {char: k for k, char in enumerate(rows[0])}
+    score = np.zeros((len(alphabet), len(alphabet)), dtype=np.int32)
+    for row in rows[1:]:
+        score[alphabet[row[0]]] = [int(value) for value in row[1:]]
+    return alphabet, score
+
+### Builds the 256 entry table encodeSeq uses, lut[byte] is the score matrix index of that symbol or -1. Build it once per score matrix and reuse it.
+def buildLut(alphabet):
+    lut = np.full(256, -1, dtype=np.int8)
+    for char, k in alphabet.items():
+        lut[ord(char)] = k
+    return lut
+
+### Turns a sequence into an int8 array of score matrix indices with one gather through the table from buildLut, indexed by the byte value of each symbol.
+### Raises ValueError for symbols that are not in the score matrix.
+def encodeSeq(lut, seq):
+    codes = lut[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+    if (codes < 0).any():
+        raise ValueError("symbol not in the score matrix: %r" % seq[int(np.argmax(codes < 0))])
+    return codes
+
+### Bit-parallel shortcut for the best score. It applies when gaps cost nothing, every symbol scores the same d > 0 against itself and nothing positive against any other symbol.
+### The best local alignment then just collects as many matches as it can, so its score is d times the longest common subsequence of the two sequences.
+### The LCS comes from the bit-parallel recurrence of Allison-Dix and Hyyro: one bit per symbol of seq1, updated with a handful of word operations per symbol of seq2.
+### Python integers have no fixed width, so sequences longer than 64 symbols simply use longer bit vectors.
+def bitParallelSW(seq1, seq2, match):
+    peq = {}
+    for k, char in enumerate(seq1):
+        peq[char] = peq.get(char, 0) | (1 << k)
+    mask = (1 << len(seq1)) - 1
+    v = mask
+    for char in seq2:
+        u = v & peq.get(char, 0)
+        v = ((v + u) | (v - u)) & mask
+    return match * (len(seq1) - bin(v).count('1'))
+
+### Returns the match score when, over the given symbol indices, the scoring reduces to a longest common subsequence as described above, otherwise 0.
+def _lcsMatch(matrix, used, openGap, extGap):
+    sub = matrix[np.ix_(used, used)]
+    match = sub[0, 0] if len(used) else 0
+    if openGap == 0 and extGap == 0 and match > 0 and (sub.diagonal() == match).all() and sub[~np.eye(len(used), dtype=bool)].max(initial=0) <= 0:
+        return int(match)
+    return 0
+
+### Returns only the best local alignment score, using bitParallelSW when the scores allow it and a full fill otherwise.
+def scoreSW(score, seq1, seq2, openGap=-2, extGap=-1):
+    alphabet, matrix = score
+    # the LCS shortcut needs free gaps, so the symbols are only looked at when the gaps allow it
+    match = _lcsMatch(matrix, np.unique(encodeSeq(buildLut(alphabet), seq1 + seq2)), openGap, extGap) if openGap == 0 and extGap == 0 else 0
+    if match:
+        return bitParallelSW(seq1, seq2, match)
+    m = SWMatrix(score, seq1, seq2, openGap, extGap)
+    m.fillMatrix()
+    return int(m.getMax())
+
+### Aligns one query (as seq1) against a list of references (each as seq2) and returns the best local alignment score of each as a NumPy array.
+### The references are sorted by length and aligned a group of lanes at a time with _batchFill, so little work is spent on padding.
+def runBatch(score, query, refs, openGap=-2, extGap=-1, lanes=32):
+    alphabet, matrix = score
+    lut = buildLut(alphabet)
+    q = np.zeros(len(query) + 1, dtype=np.intp)
+    q[1:] = encodeSeq(lut, query)
+    # all references are encoded with one gather, reference k starts at starts[k]
+    codes = encodeSeq(lut, ''.join(refs))
+    starts = np.cumsum([0] + [len(ref) for ref in refs])
+    match = _lcsMatch(matrix, np.unique(np.concatenate((q[1:], codes))), openGap, extGap) if openGap == 0 and extGap == 0 else 0
+    gpu = _hasCupy and len(refs) >= _GPU_MIN_REFS
+    if match or not (gpu or _hasNumba or _cbatch is not None):
+        return np.array([scoreSW(score, query, ref, openGap, extGap) for ref in refs], dtype=np.int32)
+    best = np.zeros(len(refs), dtype=np.int32)
+    narrow = matrix.astype(_scoreType(matrix, openGap, extGap))
+    kernel = _batchFillNative if _cbatch is not None and narrow.dtype == np.int16 else _batchFill
+    if gpu:
+        # one GPU thread per reference, the lanes are only limited by the memory for M, Ix and Iy
+        narrow, kernel, lanes = matrix, _batchFillGpu, _GPU_MIN_REFS
+    order = sorted(range(len(refs)), key=lambda k: len(refs[k]))
+    for start in range(0, len(order), lanes):
+        group = order[start:start + lanes]
+        lens = np.array([len(refs[k]) for k in group], dtype=np.intp)
+        batch = np.zeros((lens.max() + 1, len(group)), dtype=np.int8)
+        for n, k in enumerate(group):
+            batch[1:lens[n] + 1, n] = codes[starts[k]:starts[k] + lens[n]]
+        groupBest = np.zeros(len(group), dtype=np.int32)
+        kernel(narrow, q, batch, lens, openGap, extGap, groupBest)
+        if narrow.dtype == np.int16 and groupBest.max() > _scoreLimit(matrix, openGap, extGap):
+            groupBest[:] = 0
+            _batchFill(matrix, q, batch, lens, openGap, extGap, groupBest)
+        best[group] = groupBest
+    return best
 
 ### Implement your Smith-Waterman Algorithm
 def runSW(inputFile, scoreFile, openGap, extGap):
-    s = pd.read_csv(scoreFile, delimiter="\s+")
+    s = loadScore(scoreFile)
 
     with open(inputFile) as f:
         seq = f.read().splitlines()     
@@ -204,17 +673,27 @@ def runSW(inputFile, scoreFile, openGap, extGap):
         if i > 0: print(m.seq2[i], end = '\t')
         else: print('\t', end = '')
         for j in range(len(m.seq1)):
-            print(m.F.iloc[i,j], end = "\t")
+            print(m.F[i,j], end = "\t")
         print("\n", end = '')
 #alignment
     print(alignHeader)
     print("Alignment Score:", end='')
     print(m.getMax())
     print("Alignment Results:")
-    print(''.join(m.matchStr1))
-    print(''.join(m.matchLine))
-    print(''.join(m.matchStr2))
+    print(m.matchStr1)
+    print(m.matchLine)
+    print(m.matchStr2)
 
 
 ### Run your Smith-Waterman Algorithm
-runSW(args.input, args.score, int(args.opengap), int(args.extgap))
\ No newline at end of file
+if __name__ == "__main__":
+    ### This is one way to read in arguments in Python.
+    parser = argparse.ArgumentParser(description='Smith-Waterman Affine Gap Algorithm')
+    parser.add_argument('-i', '--input', help='input file', required=True)
+    parser.add_argument('-s', '--score', help='score file', required=True)
+    parser.add_argument('-o', '--opengap', help='open gap', required=False,
+    default=-2)
+    parser.add_argument('-e', '--extgap', help='extension gap', required=False,
+    default=-1)
+    args = parser.parse_args()
+    runSW(args.input, args.score, int(args.opengap), int(args.extgap))
\ No newline at end of file
@@ -0,0 +1,76 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True, language_level=3
+
+import numpy as np
+
+### Ahead of time compiled version of the fill kernel, used by SWMatrix.fillMatrix when numba is not installed.
+### It computes exactly the same tables as _fill in swalign/__init__.py, row by row instead of along antidiagonals.
+
+# the tables are int16 or int32 depending on what fillMatrix hands over, the arithmetic itself is always done in int
+ctypedef fused score_t:
+    short
+    int
+
+# pick returns the max of a, b, c and 0 and stores a number from 0-3 telling us which one it was in tag, ties go to the earliest value
+cdef inline int pick(int a, int b, int c, signed char *tag) nogil:
+    cdef int ret = a
+    tag[0] = 0
+    if b > ret:
+        ret = b
+        tag[0] = 1
+    if c > ret:
+        ret = c
+        tag[0] = 2
+    if 0 > ret:
+        ret = 0
+        tag[0] = 3
+    return ret
+
+cpdef void fill(const score_t[:, ::1] P, int o, int e, score_t[:, ::1] F,
+                unsigned char[:, ::1] T, int[::1] rowMax, Py_ssize_t[::1] rowArg):
+    cdef Py_ssize_t n = F.shape[0]
+    cdef Py_ssize_t m = F.shape[1]
+    cdef Py_ssize_t i, j, p, q
+    cdef int sc, ret1, ret2, ret3, best
+    cdef int mD, ixD, iyD, mU, ixU, iyU, mL, ixL, iyL
+    cdef signed char tag, tm, tix, tiy
+    # only two rows of M, Ix and Iy are kept, row i lives at i & 1
+    dtype = np.asarray(F).dtype
+    cdef score_t[:, ::1] M = np.zeros((2, m), dtype=dtype)
+    cdef score_t[:, ::1] Ix = np.zeros((2, m), dtype=dtype)
+    cdef score_t[:, ::1] Iy = np.zeros((2, m), dtype=dtype)
+    with nogil:
+        for i in range(1, n):
+            p = (i - 1) & 1
+            q = i & 1
+            # the upper left and left neighbours are carried along the row in locals, so each cell only loads the cell above
+            mU = ixU = iyU = 0
+            mL = ixL = iyL = 0
+            for j in range(1, m):
+                mD, ixD, iyD = mU, ixU, iyU
+                mU, ixU, iyU = M[p,j], Ix[p,j], Iy[p,j]
+
+                #compute the score for the match matrix
+                sc = P[i,j]
+                ret1 = pick(mD + sc, ixD + sc, iyD + sc, &tag)
+                tm = 3 if mD == 0 else tag
+
+                #compute the score for the Ix matrix
+                ret2 = pick(mU + o, ixU + e, iyU + o, &tag)
+                tix = 3 if ixU == 0 else tag
+
+                #compute the score for the Iy matrix
+                ret3 = pick(mL + o, ixL + o, iyL + e, &tag)
+                tiy = 3 if iyL == 0 else tag
+                T[i,j] = tm | (tix << 2) | (tiy << 4) | (64 if ret1 == 0 else 0)
+
+                M[q,j] = ret1
+                Ix[q,j] = ret2
+                Iy[q,j] = ret3
+                mL, ixL, iyL = ret1, ret2, ret3
+
+                #get best score and remember the first place it is reached in this row
+                best = max(ret1, ret2, ret3)
+                F[i,j] = best
+                if best > rowMax[i]:
+                    rowMax[i] = best
+                    rowArg[i] = j
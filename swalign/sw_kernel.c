@@ -0,0 +1,126 @@
+/* Native version of _batchFill in swalign/__init__.py, loaded with ctypes by runBatch.
+ * One query is aligned against many references at once, reference n lives in lane n and only its best score is kept.
+ * The scores are int16 and saturate instead of wrapping, runBatch redoes a group in int32 when a score gets close to the limit.
+ * With AVX2 16 lanes are done per instruction, the lanes left over (and CPUs without AVX2) go through the scalar loop.
+ * sw_batch returns 0, or -1 when its buffers could not be allocated. */
+
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define SW_HAVE_AVX2 1
+#include <immintrin.h>
+#endif
+
+static inline int sat16(int x)
+{
+    return x > INT16_MAX ? INT16_MAX : (x < INT16_MIN ? INT16_MIN : x);
+}
+
+static inline int max2(int a, int b)
+{
+    return a > b ? a : b;
+}
+
+static inline int max3(int a, int b, int c)
+{
+    return max2(max2(a, b), c);
+}
+
+/* lanes n0 to n1 one at a time, every value goes through sat16 so the results match the AVX2 loop */
+static int batch_scalar(const int16_t *score, int nsym, const intptr_t *q, int lq, const int8_t *refs, int lr, int lanes,
+                         const intptr_t *lens, int o, int e, int32_t *best, int n0, int n1)
+{
+    int16_t *M = malloc(3 * (size_t)lq * sizeof(int16_t));
+    if (M == NULL)
+        return -1;
+    int16_t *Ix = M + lq, *Iy = Ix + lq;
+    for (int n = n0; n < n1; n++) {
+        memset(M, 0, 3 * (size_t)lq * sizeof(int16_t));
+        int top = 0;
+        for (int i = 1; i < lr && i <= lens[n]; i++) {
+            const int16_t *row = score + refs[i * lanes + n];
+            int mD = 0, ixD = 0, iyD = 0, mL = 0, ixL = 0, iyL = 0;
+            for (int j = 1; j < lq; j++) {
+                int sc = row[q[j] * nsym];
+                int mU = M[j], ixU = Ix[j], iyU = Iy[j];
+                int ret1 = max2(sat16(max3(mD, ixD, iyD) + sc), 0);
+                int ret2 = max2(max3(sat16(mU + o), sat16(ixU + e), sat16(iyU + o)), 0);
+                int ret3 = max2(max3(sat16(mL + o), sat16(ixL + o), sat16(iyL + e)), 0);
+                mD = mU; ixD = ixU; iyD = iyU;
+                M[j] = mL = ret1;
+                Ix[j] = ixL = ret2;
+                Iy[j] = iyL = ret3;
+                top = max2(top, max3(ret1, ret2, ret3));
+            }
+        }
+        best[n] = top;
+    }
+    free(M);
+    return 0;
+}
+
+#ifdef SW_HAVE_AVX2
+/* 16 lanes per vector, a lane profile of the current row is built first so the inner loop only does aligned loads */
+__attribute__((target("avx2")))
+static int batch_avx2(const int16_t *score, int nsym, const intptr_t *q, int lq, const int8_t *refs, int lr, int lanes,
+                       const intptr_t *lens, int o, int e, int32_t *best, int n0)
+{
+    __m256i *M = _mm_malloc((3 * (size_t)lq + nsym) * sizeof(__m256i), 32);
+    if (M == NULL)
+        return -1;
+    __m256i *Ix = M + lq, *Iy = Ix + lq, *prof = Iy + lq;
+    int16_t *lane = (int16_t *)prof;
+    int16_t mask[16];
+    const __m256i zero = _mm256_setzero_si256();
+    const __m256i vo = _mm256_set1_epi16((int16_t)o);
+    const __m256i ve = _mm256_set1_epi16((int16_t)e);
+    for (int k = 0; k < 3 * lq; k++)
+        M[k] = zero;
+    __m256i top = zero;
+    for (int i = 1; i < lr; i++) {
+        for (int c = 0; c < nsym; c++)
+            for (int k = 0; k < 16; k++)
+                lane[c * 16 + k] = score[c * nsym + refs[i * lanes + n0 + k]];
+        /* rows past the end of a reference are padding and are kept out of the max */
+        for (int k = 0; k < 16; k++)
+            mask[k] = i <= lens[n0 + k] ? -1 : 0;
+        __m256i live = _mm256_loadu_si256((const __m256i *)mask);
+        __m256i mD = zero, ixD = zero, iyD = zero, mL = zero, ixL = zero, iyL = zero;
+        for (int j = 1; j < lq; j++) {
+            __m256i sc = prof[q[j]];
+            __m256i mU = M[j], ixU = Ix[j], iyU = Iy[j];
+            __m256i ret1 = _mm256_max_epi16(_mm256_adds_epi16(_mm256_max_epi16(_mm256_max_epi16(mD, ixD), iyD), sc), zero);
+            __m256i ret2 = _mm256_max_epi16(_mm256_max_epi16(_mm256_adds_epi16(mU, vo), _mm256_adds_epi16(ixU, ve)),
+                                            _mm256_max_epi16(_mm256_adds_epi16(iyU, vo), zero));
+            __m256i ret3 = _mm256_max_epi16(_mm256_max_epi16(_mm256_adds_epi16(mL, vo), _mm256_adds_epi16(ixL, vo)),
+                                            _mm256_max_epi16(_mm256_adds_epi16(iyL, ve), zero));
+            mD = mU; ixD = ixU; iyD = iyU;
+            M[j] = mL = ret1;
+            Ix[j] = ixL = ret2;
+            Iy[j] = iyL = ret3;
+            top = _mm256_max_epi16(top, _mm256_and_si256(_mm256_max_epi16(_mm256_max_epi16(ret1, ret2), ret3), live));
+        }
+    }
+    _mm256_storeu_si256((__m256i *)mask, top);
+    for (int k = 0; k < 16; k++)
+        best[n0 + k] = mask[k];
+    _mm_free(M);
+    return 0;
+}
+#endif
+
+/* score is nsym x nsym, q holds the query codes and refs[i * lanes + n] symbol i of reference n, both with a padding entry at 0 */
+int sw_batch(const int16_t *score, int nsym, const intptr_t *q, int lq, const int8_t *refs, int lr, int lanes,
+              const intptr_t *lens, int o, int e, int32_t *best)
+{
+    int n0 = 0;
+#ifdef SW_HAVE_AVX2
+    if (__builtin_cpu_supports("avx2"))
+        for (; n0 + 16 <= lanes; n0 += 16)
+            if (batch_avx2(score, nsym, q, lq, refs, lr, lanes, lens, o, e, best, n0) != 0)
+                return -1;
+#endif
+    return batch_scalar(score, nsym, q, lq, refs, lr, lanes, lens, o, e, best, n0, lanes);
+}